@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+''' Sorting processes into categories (for user_cpu and such), by rules like
+
+      # category          what   names...
+      (kernel+system)     comm   init getty upstart rsyslog syslog
+      (database)          user   mysql postgres
+
+    comm rules match the process name by prefix, user rules match the user name exactly.
+    The first rule (in file order) that matches decides.
+
+    All rules are compiled into a single regex (one named group per rule, run on 'user\0comm'),
+    and answers are remembered per (user, comm), so on a busy host classifying is mostly dict lookups.
+'''
+import re
+import time
+
+
+default_rules = '''
+# category          what   names...
+
+# non-kernel system stuff
+(kernel+system)     comm   init getty upstart rsyslog syslog
+# filesystem-supporting processes
+(io+filesystem)     comm   z_ zvol zfs_ arc_ l2arc_ txg_ zil_ ext4 ecryptfs jbd2
+# directly related to disk IO
+(io+filesystem)     comm   scsi ata_ kswap fsnotify writeback
+# non-driver kernel stuff
+(kernel+system)     comm   rcuos rcu_ kworker ksoftirqd kthreadd migration watchdog khelper kdevtmpfs irq/
+# web radio
+(netservices)       comm   icecast liquidsoap
+
+# users, mostly to join them in a summary
+root                user   root
+(io+filesystem)     user   xfs
+(kernel+system)     user   rpc haldaemon messagebus shutdown halt system sys bin man daemon transtec scponly
+(kernel+system)     user   statd
+(database)          user   mysql postgres
+(netservices)       user   snmp avahi list news mail uucp proxy tunnel sshd memcached memcache postfix
+(services)          user   message+ ganglia ntp lp sync backup Debian-exim Debian-gdm hplip gdm
+(munin)             user   munin
+(web)               user   apache apache2 www-data
+(appsupport)        user   solr saned gnats games tf2
+# the distinctions are thin and somewhat arbitrary, but for an overview it doesn't matter too much
+'''
+
+
+def parse_rules(text):
+    ''' Parses rules text into a list of (category, what, [names]).
+        Raises ValueError, mentioning the line, on things it doesn't understand.
+    '''
+    ret = []
+    for lineno, line in enumerate(text.splitlines()):
+        line = line.split('#',1)[0].strip()
+        if len(line)==0:
+            continue
+        fields = line.split()
+        if len(fields) < 3  or  fields[1] not in ('comm', 'user'):
+            raise ValueError('rules line %d: expected  category comm|user name [name ...], got %r'%(lineno+1, line))
+        ret.append( (fields[0], fields[1], fields[2:]) )
+    return ret
+
+
+class Classifier(object):
+    ''' Compiled rules. classify(user, comm) returns the category of the first rule that matches,
+        or fallback(user, comm) if none do (None without a fallback).
+    '''
+    def __init__(self, rules, fallback=None):
+        self.rules    = rules
+        self.fallback = fallback
+        self.memo     = {}
+        alternatives = []
+        for i, (category, what, names) in enumerate(rules):
+            names = '|'.join( re.escape(name)  for name in names )
+            if what == 'comm':
+                alternatives.append( '(?P<r%d>[^\\x00]*\\x00(?:%s))'%(i, names) )
+            else:
+                alternatives.append( '(?P<r%d>(?:%s)\\x00)'%(i, names) )
+        self.regex = re.compile( '|'.join(alternatives) )
+
+
+    def classify(self, user, comm):
+        key = (user, comm)
+        if key in self.memo:
+            return self.memo[key]
+
+        ret = None
+        m = None
+        if len(self.rules) > 0:
+            m = self.regex.match( '%s\0%s'%(user, comm) )
+        if m is not None:
+            ret = self.rules[ int(m.lastgroup[1:]) ][0]
+        elif self.fallback is not None:
+            ret = self.fallback(user, comm)
+        self.memo[key] = ret
+        return ret
+
+
+    def categories(self):
+        ' the categories the rules mention, in order '
+        ret = []
+        for category, _, _ in self.rules:
+            if category not in ret:
+                ret.append(category)
+        return ret
+
+
+    def users(self):
+        ' user -> category, for the user rules '
+        ret = {}
+        for category, what, names in self.rules:
+            if what == 'user':
+                for name in names:
+                    ret.setdefault(name, category)
+        return ret
+
+
+
+def load(path=None, fallback=None):
+    ' A Classifier from a rules file, or from default_rules if path is None '
+    if path is None:
+        text = default_rules
+    else:
+        with open(path) as f:
+            text = f.read()
+    return Classifier( parse_rules(text), fallback )
+
+
+
+if __name__ == '__main__':
+    import sys
+    import helpers_osstat
+    procs = helpers_osstat.ProcessSnapshot.scan()
+    pairs = list( zip(procs.user, procs.comm) )
+    pairs = (pairs * (1 + 10000//max(1,len(pairs))))[:10000]
+
+    t = time.time()
+    classifier = load( len(sys.argv)>1 and sys.argv[1] or None )
+    compiled = time.time()-t
+
+    t = time.time()
+    for user, comm in pairs:
+        classifier.classify(user, comm)
+    first = time.time()-t
+
+    t = time.time()
+    for user, comm in pairs:
+        classifier.classify(user, comm)
+    memoized = time.time()-t
+
+    print( 'compiling %d rules:              %8.3f ms'%(len(classifier.rules), 1000*compiled))
+    print( 'classifying 10000 processes:     %8.3f ms  (%d distinct)'%(1000*first, len(classifier.memo)))
+    print( 'and again (all memoized):        %8.3f ms'%(1000*memoized))
@@ -0,0 +1,232 @@
+''' Shared munin plugin output.
+
+    A plugin describes its graphs once, as a schema: a list of graph() dicts, each with field() dicts.
+    render_config() and render_values() turn that into what munin wants to see for a config and a fetch run,
+    so the two can't disagree about field names.
+    mode() and render() also handle munin's dirtyconfig, where one run prints both.
+
+    cached_config() keeps the config text between runs, keyed on a hash of whatever the plugin says
+    determines it (the set of devices, their names, relevant settings), so that a config run
+    can skip the expensive discovery (running smartctl, nvidia-smi, reading all counters) when nothing changed.
+
+    FieldRegistry is for plugins whose fields come and go with what is running (per process name, per user),
+    to decide which of those get their own field, with some memory, so that the set doesn't flap.
+'''
+import os
+import sys
+import zlib
+import hashlib
+
+import helpers_state
+
+
+
+def graph(name, attrs=(), fields=()):
+    ''' One graph in a schema.
+        name is the multigraph name (None for a plugin's only graph, if it does not use multigraph),
+        attrs are (attribute, value) pairs for the graph_* lines, in order, e.g. [('graph_title','IOPS'), ('graph_category','disk')]
+        fields is a list of field() dicts.
+    '''
+    return {'name':name, 'attrs':list(attrs), 'fields':list(fields)}
+
+
+def field(name, path, fmt='%d', sign=1, **attrs):
+    ''' One field in a graph.
+        name is the munin field name,
+        path is where render_values() finds its value in the data it is handed: a tuple of keys/indices, walked in order,
+        fmt and sign are how the value is printed (sign=-1 for the lower half of a mirrored graph),
+        the rest are field attributes, in order, e.g.  label='sda read', type='GAUGE', draw='LINE1'
+    '''
+    return {'name':name, 'path':tuple(path), 'fmt':fmt, 'sign':sign, 'attrs':list(attrs.items())}
+
+
+def render(schema, config=True, data=None):
+    ''' Returns output text for a schema:
+        config lines if config is true, value lines (taken from data) if data is not None, or both, per graph.
+        Missing values are reported as U (unknown) rather than leaving the field out.
+        A graph named None is printed without a multigraph line (for plugins that have only one graph).
+    '''
+    lines = []
+    for g in schema:
+        if g['name'] is not None:
+            lines.append( 'multigraph %s'%g['name'] )
+        if config:
+            for attr, value in g['attrs']:
+                lines.append( '%s %s'%(attr, value) )
+            for f in g['fields']:
+                for attr, value in f['attrs']:
+                    lines.append( '%s.%s %s'%(f['name'], attr, value) )
+        if data is not None:
+            for f in g['fields']:
+                value = lookup(data, f['path'])
+                if value is None:
+                    lines.append( '%s.value U'%f['name'] )
+                else:
+                    lines.append( '%s.value %s'%(f['name'], f['fmt']%(f['sign']*value or 0)) ) # (the or avoids -0.000)
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def render_config(schema):
+    ' Returns config output text for a schema '
+    return render(schema, config=True)
+
+
+def lookup(data, path):
+    ' walks path into data, returns None if anything along the way is missing '
+    for key in path:
+        try:
+            data = data[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return data
+
+
+def render_values(schema, data):
+    ' Returns fetch output text for a schema, taking each field\'s value from data via its path '
+    return render(schema, config=False, data=data)
+
+
+def dirtyconfig():
+    ''' True if munin-node told us (MUNIN_CAP_DIRTYCONFIG=1 in the environment) that it takes values in config output.
+        It does when both it and the munin master have dirtyconfig enabled,
+        and then skips the fetch run for plugins that send values along.
+    '''
+    return os.environ.get('MUNIN_CAP_DIRTYCONFIG', '0') == '1'
+
+
+def mode(argv=None):
+    ''' What munin wants from this run, from the arguments and environment:
+          'autoconf'
+          'config'
+          'dirtyconfig'  config, and munin takes values with it, so do a full fetch run (storing state and all)
+                         and print both, e.g. with render(schema, config=True, data=data)
+          'fetch'
+          or the argument itself for anything else (e.g. a plugin's own debug modes)
+    '''
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 2  or  argv[1] == 'fetch':
+        return 'fetch'
+    if argv[1] == 'config':
+        if dirtyconfig():
+            return 'dirtyconfig'
+        return 'config'
+    return argv[1]
+
+
+def plugin_name():
+    ' the name we were invoked as, which for wildcard plugins includes the suffix '
+    return os.path.basename(sys.argv[0])
+
+
+def entity_hash(entities):
+    ' a hash of anything with a stable repr(), e.g. sorted lists and tuples of strings and numbers '
+    return hashlib.sha1( repr(entities).encode('u8') ).hexdigest()
+
+
+def code_mtimes():
+    ' mtimes of the running plugin (symlinks resolved) and of this module, for cache keys that should change on upgrades '
+    ret = []
+    for path in (sys.argv[0], __file__):
+        try:
+            ret.append( os.stat(os.path.realpath(path)).st_mtime )
+        except OSError:
+            ret.append( None )
+    return tuple(ret)
+
+
+def cached_config(entities, make_schema, name=None):
+    ''' Returns the config text for the schema that make_schema() returns,
+        calling it only when the hash of entities differs from what the cached text was made for.
+        The plugin's own file and this one are part of that hash (by mtime), so that an upgraded plugin
+        doesn't keep serving the config of the old one until its devices change.
+        name defaults to plugin_name()
+    '''
+    if name is None:
+        name = plugin_name()
+    filename = 'munin_config_%s'%name
+    key = entity_hash( (entities, code_mtimes()) )
+    cached = helpers_state.load_pickle(filename)
+    if cached is not None  and  cached[0] == key:
+        return cached[1]
+    text = render_config( make_schema() )
+    helpers_state.store_pickle(filename, (key, text))
+    return text
+
+
+
+class FieldRegistry(object):
+    ''' Which of a changing set of names (process names, users) get their own field, kept between runs.
+
+        Every munin field is an RRD file on the master, so a name that hovers around a threshold
+        and keeps getting a field and losing it again means churn there (and gaps in its graph). So:
+        - a name gets a field once its value is at least  enter,
+        - and loses it only after being below  exit  for  linger  storing runs in a row,
+        - there are at most  max_fields  (names already in keep their place, newcomers fill what's left, biggest first),
+        - names in  pinned  always have a field.
+        Field ids are short and stable: prefix plus the CRC32 of the name, in hex
+        (on the rare collision, the next free number), remembered for as long as the name has a field.
+
+        update() with store=True (fetch runs) applies all that and stores the result.
+        With store=False (config runs) it returns what the last storing run decided, so that config and fetch agree,
+        and only decides by itself (without storing) when nothing was stored yet.
+    '''
+    def __init__(self, name, enter, exit=None, linger=12, max_fields=None, pinned=(), prefix='f'):
+        self.filename   = 'munin_fields_%s'%name
+        self.enter      = enter
+        self.exit       = enter if exit is None else exit
+        self.linger     = linger
+        self.max_fields = max_fields
+        self.pinned     = list(pinned)
+        self.prefix     = prefix
+        self.state      = helpers_state.load_pickle(self.filename) # name -> {'id':field id, 'below':storing runs below exit}
+
+
+    def _new_id(self, name, taken):
+        crc = zlib.crc32( name.encode('u8') )
+        while True:
+            fid = '%s%08x'%(self.prefix, crc)
+            if fid not in taken:
+                return fid
+            crc = (crc+1) & 0xffffffff
+
+
+    def update(self, values, store=True):
+        ''' Takes  name -> value  (None counts as 0), returns  name -> field id  for the names that get a field. '''
+        if not store  and  self.state is not None:
+            ret = dict( (name, entry['id'])  for name, entry in self.state.items() )
+            taken = set(ret.values())
+            for name in self.pinned: # (pinned since the last storing run)
+                if name not in ret:
+                    ret[name] = self._new_id(name, taken)
+                    taken.add(ret[name])
+            return ret
+
+        state = {}
+        for name, entry in (self.state or {}).items(): # who stays
+            if (values.get(name) or 0) < self.exit:
+                entry = {'id':entry['id'], 'below':entry['below']+1}
+            else:
+                entry = {'id':entry['id'], 'below':0}
+            if entry['below'] < self.linger  or  name in self.pinned:
+                state[name] = entry
+        if self.max_fields is not None  and  len(state) > self.max_fields: # e.g. lowered since. Drop the smallest.
+            keep = sorted(state, key=lambda name:(name in self.pinned, values.get(name) or 0), reverse=True)[:self.max_fields]
+            state = dict( (name, state[name])  for name in keep )
+
+        taken = set( entry['id']  for entry in state.values() )
+        newcomers = sorted( (name  for name in values  if name not in state  and  (values[name] or 0) >= self.enter),
+                            key=lambda name:values[name], reverse=True )
+        for name in self.pinned + newcomers:
+            if name in state:
+                continue
+            if name not in self.pinned  and  self.max_fields is not None  and  len(state) >= self.max_fields:
+                break
+            state[name] = {'id':self._new_id(name, taken), 'below':0}
+            taken.add( state[name]['id'] )
+
+        if store:
+            self.state = state
+            helpers_state.store_pickle(self.filename, state)
+        return dict( (name, entry['id'])  for name, entry in state.items() )
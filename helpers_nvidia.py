@@ -14,7 +14,7 @@ except ImportError:
 
 def list_targets():
     targets = []
-    p = subprocess.Popen(["/usr/bin/nvidia-smi", "-L"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    p = subprocess.Popen(["/usr/bin/nvidia-smi", "-L"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
     out, err = p.communicate()
     for line in out.strip().splitlines():
         if 'GPU' in line and ':' in line:
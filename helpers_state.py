@@ -0,0 +1,277 @@
+''' State that plugins keep between runs.
+
+    choose_state_location() picks a place for it, preferring RAM-backed directories.
+
+    CounterStore is a fixed-layout, memory-mapped file of named records of floats,
+    meant for counters that get diffed between runs (disk stats, per-process CPU time, and such),
+    and replaces pickling a dict of dicts on every run.
+
+    load_pickle() and store_pickle() are for everything else (caches of discovered things and such).
+'''
+import os
+import time
+import pickle
+import mmap
+import zlib
+import fcntl
+import struct
+
+
+
+def choose_state_location( filename, trylocs = ['/run/shm', '/dev/shm', '/tmp'] ): # Try to do this in RAM, fall back to tmp (which is probably a disk)
+    ' Returns a path to filename in the first of trylocs where we can write it (creating it if necessary), or None '
+    retpath = None
+    for trydir in trylocs:
+        if os.access(trydir, os.W_OK):
+            trypath = os.path.join(trydir, filename)
+            if os.access( trypath, os.W_OK):
+                retpath = trypath
+                break
+            else: # try creating, to be sure
+                try:
+                    f=open(trypath,'wb')
+                    f.close()
+                    retpath = trypath
+                    break
+                except IOError:
+                    pass
+    return retpath
+
+
+
+class CounterStore(object):
+    ''' A file of named records, each a fixed list of floats (the same fields for every record).
+
+        Layout (little-endian):
+          header    magic, version, field count, sequence number, slot count, CRC of the field names, name length
+          names     slots * namelen bytes, NUL-padded. All-NUL means a free slot.
+          records   slots * fields doubles
+
+        Loading and saving are struct unpacks/packs straight from/to the mapping,
+        and the name->slot index is built when opening (and only rebuilt when another process changed the names).
+
+        Updates are seqlock-style: writers (serialized with an flock) make the sequence number odd before
+        changing anything and even after, readers copy and retry if it was odd or changed meanwhile.
+        A writer that died halfway leaves it odd, which readers treat as 'no state' instead of reading garbage.
+        A writer whose index is from before another process's save (the sequence number moved) reindexes first.
+        If the store needs more slots, or the file doesn't match the fields we were given,
+        it is rebuilt as a new file that is renamed over the old one.
+
+        Missing fields are stored as NaN, and left out of the dicts that load() returns.
+    '''
+    magic   = b'MCST'
+    version = 1
+    header  = struct.Struct('<4sHHQIIH6x')
+    seq     = struct.Struct('<Q')
+    seq_offset = 8
+
+    def __init__(self, path, fields, nslots=64, namelen=48):
+        self.path    = path
+        self.fields  = tuple(fields)
+        self.namelen = namelen
+        self.fieldscrc = zlib.crc32( ' '.join(self.fields).encode('u8') )
+        self.record  = struct.Struct( '<%dd'%len(self.fields) )
+        self.nan_record = (float('nan'),)*len(self.fields)
+        self.fd = None
+        self.mm = None
+        self._open(nslots)
+
+
+    def _layout(self, nslots):
+        self.nslots      = nslots
+        self.names_off   = self.header.size
+        self.records_off = self.names_off + 8*( (nslots*self.namelen + 7)//8 )
+        self.size        = self.records_off + nslots*self.record.size
+
+
+    def _build(self, nslots, state):
+        ' Writes a complete new file with the given state, and renames it into place. '
+        self._layout(nslots)
+        buf = bytearray(self.size)
+        self.header.pack_into(buf, 0, self.magic, self.version, len(self.fields), 0, nslots, self.fieldscrc, self.namelen)
+        for slot, name in enumerate(sorted(state)):
+            self._pack(buf, slot, name, state[name])
+        tmppath = '%s.%d.tmp'%(self.path, os.getpid())
+        with open(tmppath, 'wb') as f:
+            f.write(buf)
+        os.replace(tmppath, self.path)
+
+
+    def _open(self, nslots):
+        self.close()
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            self._build(nslots, {})
+            fd = os.open(self.path, os.O_RDWR)
+
+        size = os.fstat(fd).st_size
+        valid = False
+        if size >= self.header.size:
+            magic, version, nfields, _, fnslots, fieldscrc, namelen = self.header.unpack( os.pread(fd, self.header.size, 0) )
+            if (magic, version, nfields, fieldscrc, namelen) == (self.magic, self.version, len(self.fields), self.fieldscrc, self.namelen):
+                self._layout(fnslots)
+                valid = (size == self.size)
+        if not valid: # empty, from an older version, or for other fields. Start over.
+            os.close(fd)
+            self._build(nslots, {})
+            fd = os.open(self.path, os.O_RDWR)
+
+        self.fd = fd
+        self.mm = mmap.mmap(fd, self.size)
+        self._index()
+
+
+    def _index(self):
+        ''' (Re)builds the name->slot index and the free list from the names in the file,
+            and remembers the sequence number they go with, so that save() can tell when another process changed them since.
+            Returns the slots that repeat an earlier slot's name (which only a crashed or confused writer leaves).
+        '''
+        self.index = {}
+        self.free  = []
+        dups = []
+        self.indexed_seq = self.seq.unpack_from(self.mm, self.seq_offset)[0]
+        names = self.mm[self.names_off : self.names_off + self.nslots*self.namelen]
+        for slot in range(self.nslots):
+            name = names[slot*self.namelen : (slot+1)*self.namelen].rstrip(b'\0')
+            if len(name)==0:
+                self.free.append(slot)
+            elif name.decode('u8', 'replace') in self.index:
+                dups.append(slot)
+            else:
+                self.index[ name.decode('u8', 'replace') ] = slot
+        self.free.reverse() # so pop() hands out low slots first
+        return dups
+
+
+    def _replaced(self):
+        ' True if someone renamed a new file over the one we have mapped '
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            return True
+
+
+    def _pack(self, buf, slot, name, values):
+        bname = name.encode('u8')
+        if len(bname) > self.namelen:
+            raise ValueError('name %r longer than %d bytes'%(name, self.namelen))
+        noff = self.names_off + slot*self.namelen
+        buf[noff : noff+self.namelen] = bname.ljust(self.namelen, b'\0')
+        if isinstance(values, dict):
+            values = tuple( values.get(field, float('nan'))  for field in self.fields )
+        self.record.pack_into(buf, self.records_off + slot*self.record.size, *values)
+
+
+    def _clear(self, slot):
+        noff = self.names_off + slot*self.namelen
+        self.mm[noff : noff+self.namelen] = b'\0'*self.namelen
+        self.record.pack_into(self.mm, self.records_off + slot*self.record.size, *self.nan_record)
+
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+    def load(self, retries=100):
+        ''' Returns a dict: name -> {field: value}.
+            Returns an empty dict if there is no consistent state (e.g. a writer crashed halfway).
+        '''
+        if self._replaced():
+            self._open(self.nslots)
+        for _ in range(retries):
+            seq1 = self.seq.unpack_from(self.mm, self.seq_offset)[0]
+            if seq1%2 == 0:
+                data = self.mm[:self.size]
+                if self.seq.unpack_from(self.mm, self.seq_offset)[0] == seq1:
+                    break
+            time.sleep(0.001)
+        else:
+            return {}
+
+        ret = {}
+        record_unpack_from = self.record.unpack_from
+        for slot in range(self.nslots):
+            noff = self.names_off + slot*self.namelen
+            if data[noff] == 0:
+                continue
+            name = data[noff : noff+self.namelen].rstrip(b'\0').decode('u8')
+            values = record_unpack_from(data, self.records_off + slot*self.record.size)
+            ret[name] = dict( (field, value)  for field, value in zip(self.fields, values)  if value==value ) # NaN!=NaN
+        return ret
+
+
+    def save(self, state):
+        ''' Replaces the stored state with the given  name -> {field: value}  dict
+            (values may also be tuples in field order).
+            Names not in state are removed.
+        '''
+        while True:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            if not self._replaced():
+                break
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self._open(self.nslots)
+
+        try:
+            if len(state) > self.nslots: # grow
+                self._build( max(2*self.nslots, len(state)), state )
+                self._open(self.nslots)
+                return
+
+            seq = self.seq.unpack_from(self.mm, self.seq_offset)[0]
+            dups = []
+            if seq != self.indexed_seq  or  seq%2 == 1: # another process saved since we looked, or one died halfway: look again
+                dups = self._index()
+            if seq%2 == 0:
+                seq += 1
+            self.seq.pack_into(self.mm, self.seq_offset, seq)
+
+            for slot in dups:
+                self._clear(slot)
+                self.free.append(slot)
+            for name in list(self.index):
+                if name not in state:
+                    slot = self.index.pop(name)
+                    self._clear(slot)
+                    self.free.append(slot)
+            for name in state:
+                slot = self.index.get(name)
+                if slot is None:
+                    slot = self.free.pop()
+                    self.index[name] = slot
+                self._pack(self.mm, slot, name, state[name])
+
+            self.seq.pack_into(self.mm, self.seq_offset, seq+1)
+            self.indexed_seq = seq+1
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+
+def load_pickle(filename):
+    ' Returns what store_pickle() last stored under this name, or None if there is nothing (readable) '
+    path = choose_state_location(filename)
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (EOFError, IOError, pickle.UnpicklingError):
+        return None
+
+
+def store_pickle(filename, obj):
+    ' Pickles obj to a state file, written aside and renamed into place so readers never see half of it '
+    path = choose_state_location(filename)
+    if path is None:
+        return
+    tmppath = '%s.%d.tmp'%(path, os.getpid())
+    with open(tmppath, 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmppath, path)
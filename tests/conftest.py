@@ -0,0 +1,19 @@
+import os
+import sys
+
+# the helpers are plain modules next to the plugins, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import helpers_osstat
+
+
+@pytest.fixture(params=['numpy', 'plain'])
+def numpy_or_not(request, monkeypatch):
+    ' runs a test with and without numpy, since helpers_osstat has a path for each '
+    if request.param == 'plain':
+        monkeypatch.setattr(helpers_osstat, 'numpy', None)
+    elif helpers_osstat.numpy is None:
+        pytest.skip('no numpy')
+    return request.param
@@ -0,0 +1,60 @@
+''' counter_snapshot() and counter_deltas() '''
+import helpers_osstat
+
+
+def snapshot(rows, t):
+    return helpers_osstat.counter_snapshot( rows, ('a', 'b'), t=t, btime=1000 )
+
+
+def test_counter_deltas(numpy_or_not):
+    prev = snapshot( {'x':[10, 20], 'gone':[1, 1]}, 100 )
+    cur  = snapshot( {'x':[15, 40], 'new':[1, 1]}, 110 )
+    ret = helpers_osstat.counter_deltas(prev, cur)
+    assert ret['timediff'] == 10
+    assert ret['deltas'] == {'x':{'a':5, 'b':20}}
+    assert ret['appeared'] == ['new']
+    assert ret['vanished'] == ['gone']
+    assert ret['resets'] == []
+    assert helpers_osstat.counter_deltas(prev, cur, per_second=True)['deltas'] == {'x':{'a':0.5, 'b':2}}
+
+
+def test_counter_deltas_wrap_and_reset(numpy_or_not):
+    prev = snapshot( {'wrapped':[2**32-10, 0], 'reset':[1000, 0]}, 100 )
+    cur  = snapshot( {'wrapped':[5, 0],        'reset':[50, 0]},   110 )
+    ret = helpers_osstat.counter_deltas(prev, cur, wrap_bits=32)
+    assert ret['deltas']['wrapped']['a'] == 15
+    assert ret['deltas']['reset']['a'] == 50   # what it counted since the reset
+    assert ret['resets'] == ['reset']
+    ret = helpers_osstat.counter_deltas(prev, cur) # without wrap_bits, both are resets
+    assert ret['deltas']['wrapped']['a'] == 5
+    assert sorted(ret['resets']) == ['reset', 'wrapped']
+
+
+def test_counter_deltas_missing_and_reboot(numpy_or_not):
+    nan = float('nan')
+    prev = snapshot( {'x':[10, nan]}, 100 )
+    cur  = snapshot( {'x':[15, 3]},   110 )
+    assert helpers_osstat.counter_deltas(prev, cur)['deltas'] == {'x':{'a':5}}
+    cur['btime'] = 2000
+    ret = helpers_osstat.counter_deltas(prev, cur)
+    assert ret['deltas'] == {}
+    assert ret['appeared'] == ['x']
+
+
+def test_counter_deltas_wrap_per_counter(numpy_or_not):
+    prev = snapshot( {'x':[2**32-10, 2**32-10]}, 100 )
+    cur  = snapshot( {'x':[5, 5]},               110 )
+    ret = helpers_osstat.counter_deltas(prev, cur, wrap_bits=[32, None])
+    assert ret['deltas'] == {'x':{'a':15, 'b':5}}
+    assert ret['resets'] == ['x']
+
+
+def test_disk_stats_diff_ms_wrap(numpy_or_not):
+    ' the *_ms diskstats fields are 32-bit even where the others are 64 '
+    prev = {'sda':dict( (name, 0)  for name in helpers_osstat.diskstats_fields )}
+    cur  = {'sda':dict( (name, 0)  for name in helpers_osstat.diskstats_fields )}
+    prev['sda'].update( {'time':100, 'btime':1, 'read_reqs':2**40, 'active_ms':2**32-1000, 'read_wait_ms':2**32-10} )
+    cur['sda'].update(  {'time':110, 'btime':1, 'read_reqs':2**40+10, 'active_ms':500, 'read_wait_ms':40} )
+    ret = helpers_osstat.disk_stats_diff(prev, cur)['sda']
+    assert ret['utilization_percent'] == 15
+    assert ret['read_await_ms'] == 5 # 50ms over 10 reads
@@ -0,0 +1,235 @@
+''' The disk side of helpers_osstat, on fixture files rather than this host's /proc and /sys '''
+import os
+
+import pytest
+
+import helpers_state
+import helpers_osstat
+
+
+def diskstats_line(major, minor, name, nfields):
+    return '%4d %7d %s %s\n'%( major, minor, name, ' '.join( str(100*minor + i)  for i in range(nfields) ) )
+
+
+def test_disk_readall(tmp_path):
+    for nfields in (11, 15, 17):
+        path = tmp_path / 'diskstats'
+        path.write_text( diskstats_line(8, 0, 'sda', nfields) + diskstats_line(8, 1, 'sda1', nfields) + diskstats_line(7, 2, 'loop2', nfields) )
+        ret = helpers_osstat.disk_readall(str(path))
+        assert ret['nfields'] == nfields
+        assert ret['names'] == ['sda', 'sda1', 'loop2']
+        assert ret['index']['loop2'] == 2
+        assert list(ret['major']) == [8, 8, 7]
+        assert list(ret['minor']) == [0, 1, 2]
+        for i, name in enumerate(helpers_osstat.diskstats_fields[:nfields]):
+            assert list(ret[name]) == [i, 100+i, 200+i]
+        for name in helpers_osstat.diskstats_fields[nfields:]:
+            assert name not in ret
+
+
+def test_disk_readall_ragged(tmp_path):
+    ' lines of different widths: only the fields all of them have '
+    path = tmp_path / 'diskstats'
+    path.write_text( diskstats_line(8, 0, 'sda', 17) + diskstats_line(9, 1, 'md1', 11) )
+    ret = helpers_osstat.disk_readall(str(path))
+    assert ret['nfields'] == 11
+    assert ret['names'] == ['sda', 'md1']
+    assert list(ret['active_ms']) == [9, 109]
+    assert 'flush_reqs' not in ret
+
+
+def test_serial_from_id():
+    assert helpers_osstat._serial_from_id('ata-HGST_HDN724030ALE640_PK1234P8JKASSP') == 'PK1234P8JKASSP'
+    assert helpers_osstat._serial_from_id('ata-HGST_HDN724030ALE640_PK1234P8JKASSP-part1') == 'PK1234P8JKASSP'
+    assert helpers_osstat._serial_from_id('usb-WD_Elements_25A3_57583131443633-0:0') == '57583131443633'
+    assert helpers_osstat._serial_from_id('virtio-abc123') == 'abc123'
+    for did in ('wwn-0x5000cca24ccc4e8b', 'dm-name-vg0-root', 'md-uuid-1234', 'nvme-eui.0025388b91b0e1e4', 'lvm-pv-uuid-x', 'nodash'):
+        assert helpers_osstat._serial_from_id(did) is None
+
+
+@pytest.fixture
+def disk_dirs(tmp_path, monkeypatch):
+    ' empty by-id, by-label, by-partlabel directories in place of /dev/disk/*, and state in tmp_path '
+    dirs = tuple( tmp_path / name  for name in ('by-id', 'by-label', 'by-partlabel') )
+    for path in dirs:
+        path.mkdir()
+    monkeypatch.setattr(helpers_osstat, 'disk_identity_dirs', tuple( str(path)  for path in dirs ))
+    monkeypatch.setattr(helpers_osstat, '_disk_identity', None)
+    monkeypatch.setattr(helpers_state, 'choose_state_location', lambda filename: str(tmp_path / filename))
+    return dirs
+
+
+def link(directory, name, devname):
+    (directory / name).symlink_to('../../%s'%devname)
+    os.utime( str(directory), ns=(0, os.stat(str(directory)).st_mtime_ns + 1000) ) # (so that the mtime surely changes)
+
+
+def test_disk_identity_index(disk_dirs):
+    by_id, by_label, by_partlabel = disk_dirs
+    link(by_id, 'ata-HGST_HDN724030ALE640_PK1234P8JKASSP', 'sda')
+    link(by_id, 'wwn-0x5000cca24ccc4e8b', 'sda')
+    link(by_id, 'ata-HGST_HDN724030ALE640_PK1234P8JKASSP-part1', 'sda1')
+    link(by_label, 'backup', 'sda1')
+    link(by_partlabel, 'data', 'sdb2')
+    index = helpers_osstat.disk_identity_index()
+    assert index['sda'] == {'by-id':['ata-HGST_HDN724030ALE640_PK1234P8JKASSP', 'wwn-0x5000cca24ccc4e8b'],
+                            'prodser':'HGST_HDN724030ALE640_PK1234P8JKASSP', 'serial':'PK1234P8JKASSP', 'wwn':'0x5000cca24ccc4e8b',
+                            'label':None, 'partlabel':None}
+    assert index['sda1']['label'] == 'backup'
+    assert index['sdb2'] == {'by-id':[], 'prodser':None, 'serial':None, 'wwn':None, 'label':None, 'partlabel':'data'}
+
+    assert helpers_osstat.disk_identity_index() is index       # nothing changed
+    helpers_osstat._disk_identity = None
+    assert helpers_osstat.disk_identity_index() == index       # from the state file
+    link(by_id, 'virtio-abc123', 'vda')
+    assert helpers_osstat.disk_identity_index()['vda']['serial'] == 'abc123' # links changed: rebuilt
+
+
+def diskstate(t, **counters):
+    ' a disk_getstats()-like dict: zeros for the 11 fields every kernel has, plus what is given '
+    ret = dict( (name, 0)  for name in helpers_osstat.diskstats_fields[:11] )
+    ret.update( {'time':t, 'btime':1} )
+    ret.update(counters)
+    return ret
+
+
+def test_disk_stats_diff():
+    prev = {'sda':diskstate(100), 'idle':diskstate(100)}
+    cur  = {'sda':diskstate(110, read_reqs=100, read_merge_reqs=25, read_sectors=800, read_wait_ms=200,
+                                 write_reqs=50, write_merge_reqs=50, write_sectors=400, write_wait_ms=500,
+                                 inflight_ios=2, active_ms=3000, queuetime_ms=5000),
+            'idle':diskstate(110),
+            'new':diskstate(110)}
+    ret = helpers_osstat.disk_stats_diff(prev, cur)
+    assert sorted(ret) == ['idle', 'sda'] # (no previous state for new)
+    assert ret['sda'] == {
+        'reqs':150, 'iops':15, 'read_percentage':66, 'write_percentage':33,
+        'read_bytespersecond':40960, 'write_bytespersecond':20480,
+        'activity_mspersecond':300, 'utilization_percent':30, 'readwait_mspersecond':20, 'writewait_mspersecond':50,
+        'read_await_ms':2.0, 'write_await_ms':10.0, 'service_time_ms':20.0, 'avg_queue_depth':0.5,
+        'read_request_bytes':4096.0, 'write_request_bytes':4096.0, 'read_merge_percent':20.0, 'write_merge_percent':50.0 }
+    # no IO: per-IO figures are 0 rather than a division by zero
+    assert ret['idle']['read_await_ms'] == ret['idle']['service_time_ms'] == ret['idle']['read_merge_percent'] == 0
+
+
+def test_disk_stats_diff_discard_flush():
+    ' only kernels with discard (4.18+) and flush (5.5+) fields get those figures '
+    prev = {'new':diskstate(100, discard_reqs=0, discard_sectors=0, flush_reqs=0), 'old':diskstate(100)}
+    cur  = {'new':diskstate(110, discard_reqs=5, discard_sectors=2048, flush_reqs=20), 'old':diskstate(110)}
+    ret = helpers_osstat.disk_stats_diff(prev, cur)
+    assert (ret['new']['discard_iops'], ret['new']['discard_bytespersecond'], ret['new']['flush_per_second']) == (0.5, 104857, 2.0)
+    for key in ('discard_iops', 'discard_bytespersecond', 'flush_per_second'):
+        assert key not in ret['old']
+
+
+@pytest.fixture
+def sysfs(tmp_path, monkeypatch, disk_dirs):
+    ''' A made-up /sys/class/block and /sys/block:
+        two disks with a partition each, in an md RAID1 with an LV (dm) on top, an NVMe namespace,
+        a removable disk, and loop, zram and nbd devices.
+    '''
+    root = tmp_path / 'sys'
+    def device(name, path, dev, whole=True, **files):
+        base = root / 'devices' / path
+        base.mkdir(parents=True)
+        (base / 'dev').write_text(dev+'\n')
+        for filename, content in files.items():
+            filename = filename.replace('__', '/')
+            if isinstance(content, list): # a directory of (symlink) entries, like slaves/ and holders/
+                (base / filename).mkdir(parents=True)
+                for entry in content:
+                    (base / filename / entry).write_text('')
+            else:
+                (base / filename).parent.mkdir(parents=True, exist_ok=True)
+                (base / filename).write_text(content+'\n')
+        for linkdir in ( ('class/block', 'block')  if whole  else ('class/block',) ):
+            (root / linkdir).mkdir(parents=True, exist_ok=True)
+            (root / linkdir / name).symlink_to(base)
+
+    device('sda',     'pci0/host0/block/sda',      '8:0',   removable='0', queue__rotational='1', device__wwid='naa.5000a', slaves=[], holders=[])
+    device('sda1',    'pci0/host0/block/sda/sda1', '8:1',   whole=False, partition='1', holders=['md0'])
+    device('sdb',     'pci0/host1/block/sdb',      '8:16',  removable='0', queue__rotational='1', slaves=[], holders=[])
+    device('sdb1',    'pci0/host1/block/sdb/sdb1', '8:17',  whole=False, partition='1', holders=['md0'])
+    device('md0',     'virtual/block/md0',         '9:0',   md__level='raid1', slaves=['sda1', 'sdb1'], holders=['dm-0'])
+    device('dm-0',    'virtual/block/dm-0',        '253:0', dm__name='vg0-root', slaves=['md0'], holders=[])
+    device('nvme0n1', 'pci0/nvme/nvme0/nvme0n1',   '259:0', removable='0', queue__rotational='0', wwid='eui.1234')
+    device('sdc',     'pci0/usb1/block/sdc',       '8:32',  removable='1')
+    device('loop0',   'virtual/block/loop0',       '7:0')
+    device('zram0',   'virtual/block/zram0',       '252:0', comp_algorithm='lzo')
+    device('nbd0',    'virtual/block/nbd0',        '43:0')
+
+    monkeypatch.setattr(helpers_osstat, 'sys_class_block', str(root / 'class/block'))
+    monkeypatch.setattr(helpers_osstat, 'sys_block',       str(root / 'block'))
+    helpers_osstat.disk_classify_forget()
+    yield root
+    helpers_osstat.disk_classify_forget()
+
+
+def test_disk_topology(sysfs):
+    topology = helpers_osstat.disk_topology()
+    assert sorted(topology) == ['dm-0', 'loop0', 'md0', 'nbd0', 'nvme0n1', 'sda', 'sdb', 'sdc', 'zram0'] # (no partitions)
+    assert topology['sda'] == {'layer':'physical', 'slaves':[], 'holders':[], 'identity':'naa.5000a'}
+    assert topology['md0'] == {'layer':'md', 'slaves':['sda1', 'sdb1'], 'holders':['dm-0'], 'identity':None}
+    assert topology['dm-0']['layer'] == 'dm'
+    assert topology['nvme0n1']['identity'] == 'eui.1234'
+    assert topology['sdb']['identity'] is None
+    for devname in ('loop0', 'zram0', 'nbd0'):
+        assert topology[devname]['layer'] == 'virtual'
+
+
+def changes(rates):
+    ' devname -> (read, write)  to  devname -> disk_stats_diff()-like dict '
+    return dict( (devname, {'read_bytespersecond':r, 'write_bytespersecond':w})  for devname, (r, w) in rates.items() )
+
+
+def layer(name, identity=None, holders=()):
+    return {'layer':name, 'slaves':[], 'holders':list(holders), 'identity':identity}
+
+
+def test_disk_layer_totals(sysfs):
+    ' a RAID1 of two disks, an LV on it, and a zram device: physical counts each disk once, partitions in no layer '
+    topology = {'sda':layer('physical', 'a'), 'sdb':layer('physical', 'b'), 'md0':layer('md'), 'dm-0':layer('dm'), 'zram0':layer('virtual')}
+    totals = helpers_osstat.disk_layer_totals(
+        changes({'sda':(50, 100), 'sdb':(50, 100), 'sda1':(50, 100), 'md0':(100, 100), 'dm-0':(100, 100), 'zram0':(7, 7)}),
+        topology, ('read_bytespersecond', 'write_bytespersecond') )
+    assert totals == {'physical':{'read_bytespersecond':100, 'write_bytespersecond':200},
+                      'md':      {'read_bytespersecond':100, 'write_bytespersecond':100},
+                      'dm':      {'read_bytespersecond':100, 'write_bytespersecond':100},
+                      'virtual': {'read_bytespersecond':7,   'write_bytespersecond':7}}
+
+
+def test_disk_layer_totals_multipath():
+    keys = ('read_bytespersecond', 'write_bytespersecond')
+    # dm-multipath: two paths to the same LUN, under one dm device, count as that dm device
+    topology = {'sdx':layer('physical', 'lun', ['dm-1']), 'sdy':layer('physical', 'lun', ['dm-1']), 'dm-1':layer('dm')}
+    totals = helpers_osstat.disk_layer_totals( changes({'sdx':(30, 0), 'sdy':(70, 0), 'dm-1':(100, 0)}), topology, keys )
+    assert totals['physical']['read_bytespersecond'] == 100
+    assert totals['dm']['read_bytespersecond'] == 0
+    # NVMe multipath: the hidden per-path device and the namespace, same identity, no holder: the busiest counts
+    topology = {'nvme0c0n1':layer('physical', 'eui'), 'nvme0n1':layer('physical', 'eui')}
+    totals = helpers_osstat.disk_layer_totals( changes({'nvme0c0n1':(60, 0), 'nvme0n1':(100, 0)}), topology, keys )
+    assert totals['physical']['read_bytespersecond'] == 100
+
+
+def test_disk_classify(sysfs):
+    classify = helpers_osstat.disk_classify
+    assert classify('sda')     == {'kind':'disk', 'parent':None, 'removable':False, 'rotational':True}
+    assert classify('sda1')    == {'kind':'partition', 'parent':'sda', 'removable':False, 'rotational':True} # (from its disk)
+    assert classify('nvme0n1') == {'kind':'disk', 'parent':None, 'removable':False, 'rotational':False}
+    assert classify('sdc')     == {'kind':'disk', 'parent':None, 'removable':True, 'rotational':None}
+    for devname, kind in (('md0','md'), ('dm-0','dm'), ('loop0','loop'), ('zram0','zram'), ('nbd0','virtual')):
+        assert classify(devname)['kind'] == kind
+
+
+def test_disk_device_filter(sysfs):
+    def accepted(**kwargs):
+        accept = helpers_osstat.disk_device_filter(**kwargs)
+        return list( devname  for devname, _, _ in helpers_osstat.disk_interesting_statpaths(accept=accept) )
+    assert accepted() == ['dm-0', 'md0', 'nbd0', 'nvme0n1', 'sda', 'sdb', 'sdc']
+    assert accepted(include='sda1 zram*', exclude='dm-* sd[bc]') == ['md0', 'nbd0', 'nvme0n1', 'sda', 'sda1', 'zram0']
+    assert accepted(include=['sdb'], exclude=['sd*']) == ['dm-0', 'md0', 'nbd0', 'nvme0n1', 'sdb'] # (include wins)
+    assert accepted(kinds=('loop',)) == ['loop0']
+    accept = helpers_osstat.disk_device_filter(exclude='vg0-*')
+    assert accept('dm-0')  and  not accept('dm-0', 'vg0-root') # (patterns also match the nicer name)
+    assert [ devname  for devname, _, _ in helpers_osstat.disk_interesting_statpaths(ignore_loop=False, ignore_ram=False) ] == \
+           ['dm-0', 'loop0', 'md0', 'nbd0', 'nvme0n1', 'sda', 'sdb', 'sdc', 'zram0']
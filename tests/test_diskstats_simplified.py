@@ -0,0 +1,51 @@
+''' diskstats_simplified is a plugin script; this loads it without running main() to get at its functions '''
+import os
+import array
+import runpy
+import collections
+
+import pytest
+
+import helpers_osstat
+
+
+@pytest.fixture
+def plugin():
+    return runpy.run_path( os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'diskstats_simplified'), run_name='diskstats_simplified' )
+
+
+def test_percentile(plugin):
+    values = list(range(1, 101))
+    assert plugin['percentile'](values, 95) == 95
+    assert plugin['percentile'](values, 100) == 100
+    assert plugin['percentile'](values, 0) == 1
+    assert plugin['percentile']([7], 95) == 7
+
+
+def test_summarize_rings(plugin):
+    rings = {'sda':{'iops':collections.deque([3, 1, 2, 10]), 'utilization_percent':collections.deque()}}
+    assert plugin['summarize_rings'](rings) == {'sda':{'iops':(10, 10, 4.0)}} # (no values, no entry)
+
+
+def readall(*devices):
+    return {'names':[name  for name, _ in devices],
+            'major':array.array('q', [devnum[0]  for _, devnum in devices]),
+            'minor':array.array('q', [devnum[1]  for _, devnum in devices])}
+
+
+def test_check_devices(plugin, monkeypatch):
+    mtimes = [(1, 2, 3)]
+    monkeypatch.setattr(helpers_osstat, 'dir_mtimes', lambda paths: mtimes[0])
+    names = plugin['_device_names']
+    plugin['check_devices']( readall(('sda', (8, 0))) )
+    names['sda'] = ('old', 'old')
+    helpers_osstat._disk_classes[('sda', None)] = {'kind':'old'}
+    plugin['check_devices']( readall(('sda', (8, 0))) )
+    assert names == {'sda':('old', 'old')} # nothing changed
+    plugin['check_devices']( readall(('sda', (8, 0)), ('sdb', (8, 16))) )
+    assert names == {}                     # a device came
+    assert ('sda', None) not in helpers_osstat._disk_classes
+    names['sda'] = ('old', 'old')
+    mtimes[0] = (1, 2, 4)
+    plugin['check_devices']( readall(('sda', (8, 0)), ('sdb', (8, 16))) )
+    assert names == {}                     # udev's links changed
@@ -0,0 +1,33 @@
+import pytest
+
+import helpers_classify
+
+
+rules = '''
+# category   what   names
+(ssh)        comm   ssh
+(admin)      user   root
+(shells)     comm   bash zsh
+'''
+
+def test_first_rule_wins():
+    classifier = helpers_classify.Classifier( helpers_classify.parse_rules(rules) )
+    assert classifier.classify('root', 'sshd') == '(ssh)'       # comm rule before the user rule
+    assert classifier.classify('root', 'bash') == '(admin)'     # user rule before the comm rule
+    assert classifier.classify('joe',  'bash') == '(shells)'
+    assert classifier.classify('joe',  'vim') is None
+
+
+def test_matching():
+    classifier = helpers_classify.Classifier( helpers_classify.parse_rules(rules), fallback=lambda user, comm: user )
+    assert classifier.classify('joe',   'zshell') == '(shells)'  # comm by prefix
+    assert classifier.classify('joe',   'xbash') == 'joe'
+    assert classifier.classify('rooty', 'vim') == 'rooty'        # user exactly
+    assert classifier.categories() == ['(ssh)', '(admin)', '(shells)']
+    assert classifier.users() == {'root':'(admin)'}
+
+
+def test_bad_rules():
+    with pytest.raises(ValueError, match='line 2'):
+        helpers_classify.parse_rules('(a) comm x\n(b) group y\n')
+    assert helpers_classify.Classifier([]).classify('root', 'init') is None
@@ -0,0 +1,113 @@
+''' helpers_munin's schema rendering, config cache and FieldRegistry, with state in a temporary directory '''
+import zlib
+
+import pytest
+
+import helpers_state
+import helpers_munin
+
+
+@pytest.fixture(autouse=True)
+def state_in_tmp(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers_state, 'choose_state_location', lambda filename: str(tmp_path / filename))
+
+
+def schema():
+    F = helpers_munin.field
+    return [ helpers_munin.graph('io', [('graph_title', 'IO'), ('graph_category', 'disk')], [
+                 F('sda_r', ('sda', 'r'), label='sda read', type='GAUGE'),
+                 F('sda_w', ('sda', 'w'), sign=-1, fmt='%.1f', label='sda write'),
+                 F('sdb_r', ('sdb', 'r'), label='sdb read') ]),
+             helpers_munin.graph(None, [('graph_title', 'plain')], [ F('x', ('x',)) ]) ]
+
+
+def test_render():
+    assert helpers_munin.render_config(schema()) == '\n'.join([
+        'multigraph io', 'graph_title IO', 'graph_category disk',
+        'sda_r.label sda read', 'sda_r.type GAUGE', 'sda_w.label sda write', 'sdb_r.label sdb read', '',
+        'graph_title plain', '' ])
+    data = {'sda':{'r':10.7, 'w':0}, 'x':3}
+    assert helpers_munin.render_values(schema(), data) == '\n'.join([
+        'multigraph io', 'sda_r.value 10', 'sda_w.value 0.0', 'sdb_r.value U', '',   # (missing: U, and no -0.0)
+        'x.value 3', '' ])
+    assert helpers_munin.render(schema(), config=True, data=data).count('.value ') == 4
+    data['sda']['w'] = 2.5
+    assert 'sda_w.value -2.5' in helpers_munin.render_values(schema(), data)
+
+
+def test_cached_config(monkeypatch):
+    calls = []
+    def make_schema():
+        calls.append(1)
+        return schema()
+    text = helpers_munin.cached_config( ['sda', 'sdb'], make_schema, name='test' )
+    assert text == helpers_munin.render_config(schema())
+    assert helpers_munin.cached_config( ['sda', 'sdb'], make_schema, name='test' ) == text
+    assert len(calls) == 1
+    helpers_munin.cached_config( ['sda'], make_schema, name='test' )             # other entities
+    assert len(calls) == 2
+    monkeypatch.setattr(helpers_munin, 'code_mtimes', lambda: (1.0, 2.0))       # an upgraded plugin or helper
+    helpers_munin.cached_config( ['sda'], make_schema, name='test' )
+    assert len(calls) == 3
+
+
+def test_mode(monkeypatch):
+    monkeypatch.delenv('MUNIN_CAP_DIRTYCONFIG', raising=False)
+    assert helpers_munin.mode(['x']) == 'fetch'
+    assert helpers_munin.mode(['x', 'fetch']) == 'fetch'
+    assert helpers_munin.mode(['x', 'config']) == 'config'
+    assert helpers_munin.mode(['x', 'autoconf']) == 'autoconf'
+    assert helpers_munin.mode(['x', 'debug']) == 'debug'
+    monkeypatch.setenv('MUNIN_CAP_DIRTYCONFIG', '1')
+    assert helpers_munin.mode(['x', 'config']) == 'dirtyconfig'
+    assert helpers_munin.mode(['x']) == 'fetch'
+    monkeypatch.setenv('MUNIN_CAP_DIRTYCONFIG', '0')
+    assert helpers_munin.mode(['x', 'config']) == 'config'
+
+
+def registry(**kwargs):
+    return helpers_munin.FieldRegistry('test', 100, 50, **kwargs)
+
+
+def test_enter_exit_linger():
+    assert registry(linger=2).update( {'big':100, 'small':99} ) == {'big':'f%08x'%zlib.crc32(b'big')}
+    for _ in range(2): # between exit and enter: stays
+        assert list( registry(linger=2).update({'big':60}) ) == ['big']
+    assert list( registry(linger=2).update({'big':10}) ) == ['big']  # below exit once
+    assert list( registry(linger=2).update({'big':60}) ) == ['big']  # back above exit, which starts over
+    assert list( registry(linger=2).update({'big':10}) ) == ['big']
+    assert registry(linger=2).update({'big':10}) == {}               # below exit twice in a row
+
+
+def test_ids_are_stable():
+    fields = registry().update( {'a':100, 'b':200} )
+    assert registry().update( {'b':100, 'c':300, 'a':100} ) == dict(fields, c='f%08x'%zlib.crc32(b'c'))
+    assert len( set(fields.values()) ) == 2
+
+
+def test_store_false():
+    assert list( registry().update({'a':100}, store=False) ) == ['a'] # nothing stored yet: decides by itself
+    assert registry().update( {}, store=False ) == {}                 # still nothing stored
+    fields = registry().update( {'a':100} )
+    assert registry().update( {'b':1000}, store=False ) == fields      # what the last storing run decided
+
+
+def test_max_fields():
+    assert sorted( registry(max_fields=2).update({'a':100, 'b':300, 'c':200}) ) == ['b', 'c']
+    # who has a field keeps it over bigger newcomers
+    assert sorted( registry(max_fields=2).update({'a':1000, 'b':300, 'c':200}) ) == ['b', 'c']
+    # lowered since: the smallest go
+    assert sorted( registry(max_fields=1).update({'b':300, 'c':200}) ) == ['b']
+
+
+def test_pinned():
+    # pinned names count towards max_fields
+    assert sorted( registry(pinned=['(others)'], max_fields=2, linger=1).update({'a':100, 'b':200}) ) == ['(others)', 'b']
+    assert sorted( registry(pinned=['(others)'], max_fields=2, linger=1).update({}) ) == ['(others)']
+    assert sorted( registry(pinned=['(others)', 'new'], linger=1).update({}, store=False) ) == ['(others)', 'new']
+
+
+def test_id_collision():
+    reg = registry()
+    taken = set([ reg._new_id('a', ()) ])
+    assert reg._new_id('a', taken) not in taken
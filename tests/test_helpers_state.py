@@ -0,0 +1,70 @@
+''' CounterStore, with several handles on one file like separate plugin runs would have '''
+import random
+
+import helpers_state
+
+
+fields = ('a', 'b')
+
+def store(tmp_path, nslots=4, fields=fields):
+    return helpers_state.CounterStore( str(tmp_path / 'counters'), fields, nslots=nslots )
+
+
+def test_roundtrip(tmp_path):
+    s = store(tmp_path)
+    assert s.load() == {}
+    s.save( {'sda':{'a':1, 'b':2}, 'sdb':(3, float('nan'))} )
+    assert store(tmp_path).load() == {'sda':{'a':1, 'b':2}, 'sdb':{'a':3}}
+    s.save( {'sdb':{'a':4}} )
+    assert store(tmp_path).load() == {'sdb':{'a':4}}
+
+
+def test_interleaved_handles(tmp_path):
+    a, b = store(tmp_path), store(tmp_path)
+    a.save( {'sda':{'a':1}} )
+    b.save( {'sdb':{'a':2}, 'sda':{'a':5}} )
+    a.save( {'sda':{'a':9}} )
+    assert b.load() == {'sda':{'a':9}}
+
+
+def test_interleaved_handles_random(tmp_path):
+    rnd = random.Random(1)
+    handles = [ store(tmp_path, nslots=8)  for _ in range(3) ]
+    for _ in range(300):
+        names = rnd.sample( ['sd%s'%c  for c in 'abcdefgh'], rnd.randint(0, 8) )
+        state = dict( (name, {'a':rnd.randint(0, 1000)})  for name in names )
+        rnd.choice(handles).save(state)
+        assert rnd.choice(handles).load() == state
+
+
+def test_grow(tmp_path):
+    a, b = store(tmp_path, nslots=2), store(tmp_path, nslots=2)
+    state = dict( ('sd%s'%c, {'a':i})  for i, c in enumerate('abcde') )
+    a.save(state)
+    assert a.nslots >= 5
+    assert b.load() == state # (b notices the file was replaced)
+    b.save( {'sda':{'a':1}} )
+    assert a.load() == {'sda':{'a':1}}
+
+
+def test_fields_change(tmp_path):
+    store(tmp_path).save( {'sda':{'a':1}} )
+    s = store(tmp_path, fields=('a', 'b', 'c'))
+    assert s.load() == {} # other fields: starts over
+    s.save( {'sda':{'c':3}} )
+    assert store(tmp_path, fields=('a', 'b', 'c')).load() == {'sda':{'c':3}}
+
+
+def test_odd_seq(tmp_path):
+    ' a writer that died halfway leaves an odd sequence number: no state, until the next save '
+    s = store(tmp_path)
+    s.save( {'sda':{'a':1}, 'sdb':{'a':2}} )
+    seq = s.seq.unpack_from(s.mm, s.seq_offset)[0]
+    s.seq.pack_into(s.mm, s.seq_offset, seq+1)
+    s._pack(s.mm, 2, 'sda', (7, 7)) # (and left a second sda behind)
+    assert store(tmp_path).load(retries=2) == {}
+    other = store(tmp_path)
+    other.save( {'sda':{'a':3}} )
+    assert s.load() == {'sda':{'a':3}}
+    s.save( {'sda':{'a':4}, 'sdc':{'a':5}} )
+    assert other.load() == {'sda':{'a':4}, 'sdc':{'a':5}}
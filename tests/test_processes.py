@@ -0,0 +1,90 @@
+''' The process side of helpers_osstat, on fixed inputs where it can (dirs_via_proc() looks at this process itself) '''
+import os
+
+import helpers_osstat
+
+
+def test_parse_stat():
+    comm, fields = helpers_osstat._parse_stat(b'123 (a (b) c)) S 1 123 123 0 -1 4194560\n')
+    assert comm == 'a (b) c)'
+    assert fields[:3] == [b'S', b'1', b'123']
+
+
+def test_processsnapshot_groupby(numpy_or_not):
+    procs = helpers_osstat.ProcessSnapshot()
+    procs.uid.extend( [0, 1000, 1000, 33] )
+    procs.rss.extend( [10, 20, 30, 40] )
+    procs.user.extend( ['root', 'joe', 'joe', 'www-data'] )
+    procs.comm.extend( ['sshd', 'bash', 'sshd', 'nginx'] )
+    assert procs.groupby('uid') == {0:10, 1000:50, 33:40}
+    assert procs.groupby('uid', [1.5, 1, 1, 0]) == {0:1.5, 1000:2, 33:0}
+    assert procs.groupby('comm') == {'sshd':40, 'bash':20, 'nginx':40}
+    calls = []
+    def by(user, comm):
+        calls.append( (user, comm) )
+        return comm == 'sshd' and 'ssh' or user
+    assert procs.groupby(by) == {'ssh':40, 'joe':20, 'www-data':40}
+    assert len(calls) == 4 # once per distinct (user, comm)
+    assert helpers_osstat.ProcessSnapshot().groupby('uid') == {}
+
+
+def test_dirs_via_proc(tmp_path):
+    ' on ourselves: directories open with and without O_DIRECTORY, and with O_PATH, count; files do not '
+    (tmp_path / 'plain').mkdir()
+    (tmp_path / 'opath').mkdir()
+    (tmp_path / 'odir').mkdir()
+    (tmp_path / 'file').write_text('x')
+    fds = [ os.open(str(tmp_path / 'plain'), os.O_RDONLY),
+            os.open(str(tmp_path / 'opath'), os.O_PATH),
+            os.open(str(tmp_path / 'odir'),  os.O_RDONLY|os.O_DIRECTORY),
+            os.open(str(tmp_path / 'file'),  os.O_RDONLY) ]
+    try:
+        pid = os.getpid()
+        dirs = helpers_osstat.dirs_via_proc(cwd_only=False, pids=[pid])[pid]
+        for name in ('plain', 'opath', 'odir'):
+            assert str(tmp_path / name) in dirs
+        assert str(tmp_path / 'file') not in dirs
+        assert os.getcwd() in dirs
+        assert helpers_osstat.dirs_via_proc(pids=[pid]) == {pid:set([os.getcwd()])}
+        assert helpers_osstat.dirs_via_lsof(cwd_only=False, pids=[pid]) == {pid:dirs}
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def test_dirs_via_proc_gone():
+    assert helpers_osstat.dirs_via_proc(pids=[2**22+1]) == {} # (above pid_max)
+    assert len( helpers_osstat.dirs_via_lsof(pids=[]) ) > 1   # (empty means all, as it did with lsof)
+
+
+smaps_rollup = b"""55d0c0a00000-7ffd5d9f5000 ---p 00000000 00:00 0                          [rollup]
+Rss:                8240 kB
+Pss:                3128 kB
+Pss_Anon:           1800 kB
+Shared_Clean:       5000 kB
+Shared_Dirty:        100 kB
+Private_Clean:       640 kB
+Private_Dirty:      2500 kB
+Referenced:         8000 kB
+Anonymous:          2500 kB
+Swap:                 64 kB
+SwapPss:              32 kB
+Locked:                0 kB
+"""
+
+def test_parse_smaps_rollup():
+    assert helpers_osstat._parse_smaps_rollup(smaps_rollup) == {
+        'rss':8240*1024, 'pss':3128*1024, 'uss':(640+2500)*1024, 'swap':64*1024, 'swap_pss':32*1024 }
+    # older kernels have no SwapPss
+    assert helpers_osstat._parse_smaps_rollup( smaps_rollup.replace(b'SwapPss:', b'Other:') )['swap_pss'] == 64*1024
+    assert helpers_osstat._parse_smaps_rollup(b'') is None # kernel threads
+
+
+def test_smaps_rollup_many():
+    ' on ourselves, and a PID that does not exist, serially and threaded '
+    pid = os.getpid()
+    assert helpers_osstat.smaps_rollup(2**22+1) is None
+    for workers in (1, 4):
+        ret = helpers_osstat.smaps_rollup_many( [pid, pid, 2**22+1], workers=workers )
+        assert list(ret) == [pid]
+        assert ret[pid]['rss'] >= ret[pid]['pss'] >= ret[pid]['uss'] > 0
@@ -0,0 +1,57 @@
+''' procio_'s io_rates(), over two runs with a made-up process table (procio_ is a plugin script, this runs it as autoconf) '''
+import os
+import sys
+import time
+import runpy
+
+import pytest
+
+import helpers_state
+import helpers_osstat
+
+
+@pytest.fixture
+def procio(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(helpers_state, 'choose_state_location', lambda filename: str(tmp_path / filename))
+    monkeypatch.setattr(sys, 'argv', ['procio_comm', 'autoconf'])
+    ret = runpy.run_path( os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'procio_'), run_name='procio_' )
+    capsys.readouterr()
+    return ret
+
+
+def run(procio, monkeypatch, now, uptime, procs, btime=1000):
+    ''' procs is a list of (pid, ppid, starttime in seconds, comm, read_bytes, write_bytes, cancelled_write_bytes) '''
+    snapshot = helpers_osstat.ProcessSnapshot()
+    ios = {}
+    for pid, ppid, start, comm, r, w, c in procs:
+        snapshot.pid.append(pid)
+        snapshot.ppid.append(ppid)
+        snapshot.starttime.append( int(start*helpers_osstat.clock_ticks) )
+        snapshot.comm.append(comm)
+        snapshot.user.append('joe')
+        ios[pid] = {'read_bytes':r, 'write_bytes':w, 'cancelled_write_bytes':c}
+    monkeypatch.setattr(helpers_osstat.ProcessSnapshot, 'scan', classmethod(lambda cls: snapshot))
+    monkeypatch.setattr(helpers_osstat, 'proc_io', lambda pid, buf=None: ios[pid])
+    monkeypatch.setattr(helpers_osstat, 'boot_time', lambda: btime)
+    monkeypatch.setattr(helpers_osstat, 'uptime', lambda: uptime)
+    monkeypatch.setattr(time, 'time', lambda: now)
+    return procio['io_rates']()
+
+
+def test_io_rates(procio, monkeypatch):
+    assert run(procio, monkeypatch, 2000, 400, [
+        (10, 1, 1,   'parent', 1000, 0,   0),
+        (20, 10, 2,  'child',  500,  300, 100),
+        (2,  0,  0,  'kthreadd', 0, 0, 0),
+        ]) is None # (nothing to diff against yet)
+
+    rates = run(procio, monkeypatch, 2010, 410, [
+        (10, 1, 1,   'parent', 1000+50+600, 400, 100), # now with what the child did, 100 more read than we saw, and 100 more written
+        (20, 1, 405, 'newer',  70, 0, 0),              # same PID, started since the last run: everything it did counts
+        ])
+    assert rates == {'parent':(15.0, 10.0), 'newer':(7.0, 0.0)}
+
+
+def test_io_rates_reboot(procio, monkeypatch):
+    run(procio, monkeypatch, 2000, 400, [ (10, 1, 1, 'a', 1000, 0, 0) ])
+    assert run(procio, monkeypatch, 2010, 5, [ (10, 1, 1, 'a', 10, 0, 0) ], btime=1900) is None
@@ -0,0 +1,48 @@
+''' user_cpu is a plugin script, so this runs it (as autoconf, which does nothing much) to get at its functions '''
+import os
+import sys
+import runpy
+
+import pytest
+
+import helpers_state
+import helpers_osstat
+
+
+@pytest.fixture
+def user_cpu(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(helpers_state, 'choose_state_location', lambda filename: str(tmp_path / filename))
+    monkeypatch.setattr(sys, 'argv', ['user_cpu', 'autoconf'])
+    ret = runpy.run_path( os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'user_cpu'), run_name='user_cpu' )
+    capsys.readouterr()
+    return ret
+
+
+def snapshot(rows):
+    ' rows of (pid, ppid, starttime, utime+stime, cutime+cstime) '
+    procs = helpers_osstat.ProcessSnapshot()
+    for pid, ppid, starttime, ticks, cticks in rows:
+        for column, value in (('pid',pid), ('ppid',ppid), ('starttime',starttime), ('utime',ticks), ('stime',0), ('cutime',cticks), ('cstime',0)):
+            getattr(procs, column).append(value)
+    return procs
+
+
+def test_ticks_since(user_cpu):
+    prev = {
+        '(sample)':{'time':0, 'btime':0},
+        '10:1': {'ticks':100, 'cticks':0, 'ppid':1},
+        '20:5': {'ticks':30,  'cticks':0, 'ppid':10}, # exits, reaped by 10
+        '30:6': {'ticks':5,   'cticks':0, 'ppid':20}, # exits before its parent, so it ends up in 10's cticks too
+        '40:7': {'ticks':8,   'cticks':0, 'ppid':1},  # exits, and its PID is reused
+    }
+    procs = snapshot([
+        (10, 1, 1, 110, 50), # 30+5 from the children we saw, 15 from ones we never saw
+        (40, 1, 9, 3,   0),
+        (50, 1, 8, 7,   2),
+    ])
+    assert user_cpu['ticks_since'](procs, prev) == {10:10+15, 40:3, 50:9}
+
+
+def test_ticks_since_counters_going_down(user_cpu):
+    procs = snapshot([ (10, 1, 1, 90, 0) ])
+    assert user_cpu['ticks_since'](procs, {'10:1':{'ticks':100, 'cticks':0, 'ppid':1}}) == {10:0}